@@ -87,6 +87,16 @@ def extract_settings(config_data: dict, os_str: str) -> dict:
         warnings.warn(f"\nquick_and_dirty not defined. "
                       f"Using {settings['quick_and_dirty']}.")
 
+    if "maxWorkers" not in settings:
+        settings["maxWorkers"] = 0
+        warnings.warn(f"\nmaxWorkers not defined. "
+                      f"Using {settings['maxWorkers']} (automatic).")
+
+    if "backupInterResults" not in settings:
+        settings["backupInterResults"] = 1
+        warnings.warn(f"\nbackupInterResults not defined. "
+                      f"Using {settings['backupInterResults']}.")
+
     return settings
 
 
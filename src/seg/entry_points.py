@@ -1,13 +1,10 @@
 import os
 from tqdm import tqdm
-import gzip
 import numpy as np
 import nibabel as nib
-import skimage.morphology as morph
-from scipy.ndimage import affine_transform
+from scipy import ndimage
 from path_planning import generate_distance_map
-from util.nifti import load_nifti
-from util.freesurfer import extract_tissues
+from util.nifti import load_nifti, resample_to_grid
 
 
 def find_mask_edges(mask: np.ndarray) -> np.ndarray:
@@ -18,10 +15,10 @@ def find_mask_edges(mask: np.ndarray) -> np.ndarray:
     """
 
     # Define morphological element
-    element = morph.ball(1)
+    element = ndimage.generate_binary_structure(3, 1)
 
     # Perform erosion
-    mask_eroded = morph.binary_erosion(mask, element)
+    mask_eroded = ndimage.binary_erosion(mask, element, border_value=1)
 
     # Generate border masks
     mask_borders = mask - mask_eroded
@@ -42,9 +39,7 @@ def extract_entry_points(processing_paths: dict,
     nogo_np, aff, hdr = load_nifti(processing_paths["nogo_mask"])
     labels_np, aff_fs, _ = load_nifti(processing_paths["fs_labels_path"])
 
-    with gzip.open(processing_paths["orig_path"], 'rb') as mgh_file_handle:
-        mgh_header = \
-            nib.freesurfer.mghformat.MGHHeader.from_fileobj(mgh_file_handle)
+    mgh_header = nib.load(processing_paths["orig_path"]).header
 
     # Generate empty mask
     mask = np.zeros(np.shape(labels_np))
@@ -102,36 +97,22 @@ def extract_entry_points(processing_paths: dict,
     # Transform entry point coordinates from RAS to voxel space
     ras2vox_aff = np.linalg.inv(mgh_header.get_vox2ras_tkr())
 
-    entry_points_vox = np.zeros(np.shape(entry_points_ras))
-    for i in range(np.shape(entry_points_vox)[0]):
-        entry_points_vox[i] = (
-            ras2vox_aff.dot(np.array([*entry_points_ras[i], 1]))
-        )[:-1].astype(int)
+    entry_points_vox = (
+        entry_points_ras.dot(ras2vox_aff[:3, :3].T) + ras2vox_aff[:3, 3]
+    ).astype(int)
 
     # Convert entry point list to mask
-    for i in range(np.shape(entry_points_vox)[0]):
-        indices = entry_points_vox[i].astype(int)
-        mask[indices[0], indices[1], indices[2]] = 1.0
-
-    # Perform affine transform to subject space
-    if not (aff_fs == aff).all():
-        aff_translation = (np.linalg.inv(aff_fs)).dot(aff)
-        mask = affine_transform(
-            mask, aff_translation,
-            output_shape=np.shape(nogo_np)
-        )
+    mask[tuple(entry_points_vox.T)] = 1.0
+
+    # Perform affine transform to subject space (if applicable)
+    mask = resample_to_grid(mask, aff_fs, aff, np.shape(nogo_np))
 
     # Import no-go mask to numpy
     nogo_mask, aff_nogo, _ = \
         load_nifti(processing_paths["nogo_mask"])
 
     # Perform affine transform (if applicable)
-    if not (aff_nogo == aff).all():
-        aff_translation = (np.linalg.inv(aff_nogo)).dot(aff)
-        nogo_mask = affine_transform(
-            nogo_mask, aff_translation,
-            output_shape=np.shape(mask)
-        )
+    nogo_mask = resample_to_grid(nogo_mask, aff_nogo, aff, np.shape(mask))
 
     # Remove all no-go voxels from entry point mask
     mask[nogo_mask < 1e-2] = 0.0
@@ -141,12 +122,7 @@ def extract_entry_points(processing_paths: dict,
         load_nifti(processing_paths["bet_path"])
 
     # Perform affine transform (if applicable)
-    if not (aff_bet == aff).all():
-        aff_translation = (np.linalg.inv(aff_bet)).dot(aff)
-        bet_img = affine_transform(
-            bet_img, aff_translation,
-            output_shape=np.shape(mask)
-        )
+    bet_img = resample_to_grid(bet_img, aff_bet, aff, np.shape(mask))
 
     # Binarize BET image
     bet_mask = np.zeros(np.shape(bet_img))
@@ -180,7 +156,7 @@ def seg_entry_points(paths: dict, settings: dict, verbose: bool = True) \
     if "seg_paths" not in paths:
         paths["seg_paths"] = {}
 
-    if not os.path.isdir(paths["segDir"]): os.mkdir(paths["segDir"])
+    os.makedirs(paths["segDir"], exist_ok=True)
 
     # Define iterator
     if verbose:
@@ -39,8 +39,7 @@ def generate_fsl_paths(paths: dict, settings: dict) -> tuple[list, dict]:
     # If applicable, make fsl directory
     if "fslDir" not in paths:
         paths["fslDir"] = os.path.join(paths["tmpDataDir"], "fsl")
-    if not os.path.isdir(paths["fslDir"]):
-        os.mkdir(paths["fslDir"])
+    os.makedirs(paths["fslDir"], exist_ok=True)
 
     # Create fsl paths struct
     if "fsl_paths" not in paths: paths["fsl_paths"] = {}
@@ -181,7 +180,7 @@ def fsl_fast(fsl_paths: list, paths: dict, settings: dict,
 
     # Restructure output files
     fastDir = os.path.join(paths["fsl_paths"][subject]["dir"], "fast_raw")
-    if not os.path.isdir(fastDir): os.mkdir(fastDir)
+    os.makedirs(fastDir, exist_ok=True)
 
     fast_output = glob(path_fast_base + "_*.nii.gz")
     for path in fast_output:
@@ -236,7 +235,7 @@ def process_fsl(paths: dict, settings: dict,
     for subject_paths in iterator:
         # Create subject directory
         subjectDir = paths["fsl_paths"][subject_paths[0]]["dir"]
-        if not os.path.isdir(subjectDir): os.mkdir(subjectDir)
+        os.makedirs(subjectDir, exist_ok=True)
 
         # Check whether results are already there
         ok_paths = [path for path in subject_paths[2:] if os.path.exists(path)]
@@ -2,12 +2,17 @@
 
 import numpy as np
 import nibabel as nib
+import skimage.morphology as morph
+from functools import lru_cache
 from scipy import ndimage
 
 
-def binarize_mask(pve_path: str, mask_path: str, treshold: float = 0.5):
+def binarize_mask(pve_path: str, mask_path: str,
+                  treshold: float = 0.5) -> np.ndarray:
     """
     This function binarizes pve maps.
+    The mask is stored at mask_path and also returned,
+    so that callers don't have to reload it.
     """
 
     # Load the PVE image
@@ -18,14 +23,14 @@ def binarize_mask(pve_path: str, mask_path: str, treshold: float = 0.5):
     pve_map = pve_img.get_fdata()
 
     # Create mask data map
-    mask_map = np.zeros(np.shape(pve_map))
-    mask_map[pve_map < treshold] = 0
-    mask_map[pve_map >= treshold] = 1
+    mask_map = (pve_map >= treshold).astype(np.int16)
 
     # Store mask
-    mask_img = nib.Nifti1Image(mask_map.astype(np.int16), img_aff, img_hdr)
+    mask_img = nib.Nifti1Image(mask_map, img_aff, img_hdr)
     nib.save(mask_img, mask_path)
 
+    return mask_map
+
 
 def find_center(img_as_np: np.ndarray, treshold: float = 1e-2):
     """
@@ -34,11 +39,67 @@ def find_center(img_as_np: np.ndarray, treshold: float = 1e-2):
     """
 
     # Binarize image based on certain treshold
-    bin_img = np.zeros(np.shape(img_as_np))
-    bin_img[img_as_np < treshold] = 0
-    bin_img[img_as_np >= treshold] = 1
+    bin_img = (img_as_np >= treshold).astype(np.uint8)
 
     # Extract center of mass (center of mask)
     coords = ndimage.measurements.center_of_mass(bin_img)
 
     return coords
+
+
+def ellipsoid_element(radius: float, img_aff: np.ndarray) -> np.ndarray:
+    """
+    This function builds a binary structuring element with a
+    physical radius of 'radius' [mm] in every direction.
+    The voxel dimensions are taken from the affine matrix (the norms
+    of its columns, so that they also hold for rotated or flipped
+    affines, e.g. FreeSurfer's LIA orientation). For anisotropic
+    voxels, the element becomes an ellipsoid along the voxel axes.
+    For isotropic voxels, this equals morph.ball(int(radius / vox_dim)).
+    """
+
+    # Determine voxel dimensions along every array axis
+    vox_dims = np.linalg.norm(np.asarray(img_aff)[:3, :3], axis=0)
+    if not np.all(np.isfinite(vox_dims) & (vox_dims > 0.)):
+        raise ValueError("Invalid voxel dimensions in affine matrix: "
+                         f"{vox_dims}")
+
+    # Determine element radius (in voxels) along every axis
+    radii = (radius / vox_dims).astype(int)
+
+    # Build element from the normalized distance to its center
+    grid = np.ogrid[tuple(slice(-r, r + 1) for r in radii)]
+    distance = sum((axis / max(r, 1)) ** 2 for axis, r in zip(grid, radii))
+
+    return distance <= 1.
+
+
+@lru_cache(maxsize=32)
+def ball_element(radius: int) -> np.ndarray:
+    """
+    This function builds a binary ball-shaped structuring element
+    with a radius of 'radius' voxels. Elements are cached per radius,
+    so they are returned as read-only arrays.
+    """
+
+    # Build element and protect the cached copy from modification
+    element = morph.ball(radius).astype(bool)
+    element.flags.writeable = False
+
+    return element
+
+
+def closing(mask: np.ndarray, element: np.ndarray) -> np.ndarray:
+    """
+    This function performs a morphological closing of a binary mask.
+    It is a greyscale closing, which mirrors the mask at the volume
+    border (as skimage's morph.closing does). A binary closing would
+    pad the border with zeros, removing voxels near the volume edge.
+    """
+
+    # Perform closing on a uint8 view of the (boolean) mask
+    mask = mask.astype(bool, copy=False)
+    closed_mask = ndimage.grey_closing(mask.view(np.uint8),
+                                       footprint=element)
+
+    return closed_mask.view(bool)
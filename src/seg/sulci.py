@@ -2,14 +2,13 @@
 
 import os
 import subprocess
-import gzip
 import nibabel as nib
 import numpy as np
-import skimage.morphology as morph
-from scipy.ndimage import affine_transform
-from tqdm import tqdm
+from scipy import ndimage
 from path_planning import generate_distance_map
-from util.nifti import load_nifti
+from seg.mask_util import ellipsoid_element
+from util.nifti import load_nifti, resample_to_grid
+from util.general import run_parallel
 
 
 def extract_sulci_fsl(bet_img_path: str, csf_mask_path: str,
@@ -40,13 +39,16 @@ def extract_sulci_fs(seg_paths: dict):
             "threshold": 0.2}
 
     # --- Initialize main mask ---
-    data, aff, hdr = load_nifti(seg_paths["ribbon"])
-    mask_as_np = np.zeros(np.shape(data))
+    # We only need the ribbon's header here, so we don't load its data
+    ribbon_img = nib.load(seg_paths["ribbon"])
+    aff, hdr = ribbon_img.affine, ribbon_img.header
+    ribbon_shape = ribbon_img.shape
+    mask_as_np = np.zeros(ribbon_shape, dtype=bool)
 
-    for surf in [sulc, curv]:
-
-        # --- Project pial surfaces to volume file ---
+    # --- Project pial surfaces to volume files ---
+    # Both projections are independent, so we run them concurrently
 
+    for surf in [sulc, curv]:
         # Assemble command
         command = ["mri_surf2vol",
                    "--o", surf["nii"],
@@ -55,12 +57,16 @@ def extract_sulci_fs(seg_paths: dict):
                    "--so", seg_paths["lh_pial"], surf["lh_surf"]]
 
         # Open stream and pass command
-        recon_stream = subprocess.Popen(command, stdout=subprocess.PIPE,
-                                        stderr=subprocess.PIPE)
-        # Read output
-        msg, error = recon_stream.communicate()
-        # End stream
-        recon_stream.terminate()
+        surf["stream"] = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                          stderr=subprocess.PIPE)
+
+    # Read outputs (and wait for both processes to finish),
+    # before raising any errors
+    for surf in [sulc, curv]:
+        _, surf["error"] = surf.pop("stream").communicate()
+
+    for surf in [sulc, curv]:
+        error = surf.pop("error")
 
         if error:
             raise UserWarning("Fatal error occured during command-line "
@@ -68,26 +74,29 @@ def extract_sulci_fs(seg_paths: dict):
                               "\nExited with error message:\n"
                               f"{error.decode('utf-8')}")
 
-        # --- Binarize masks ---
+    # --- Binarize masks ---
 
-        # Load nifti file
-        data, _, _ = load_nifti(surf["nii"])
+    for surf in [sulc, curv]:
+        # Load nifti file (and keep its affine for later use)
+        # Single precision suffices for thresholding, but we
+        # accumulate the statistics in double precision
+        data, surf["aff"], _ = load_nifti(surf["nii"], dtype=np.float32)
 
         # Calculate treshold
-        treshold = np.mean(data) + surf["threshold"] * np.std(data)
+        treshold = np.mean(data, dtype=np.float64) + \
+            surf["threshold"] * np.std(data, dtype=np.float64)
 
-        # Update mask
-        mask_as_np[data > treshold] = 1
-        mask_as_np[data == 0] = 0
+        # Update mask (in-place)
+        mask_as_np |= data > treshold
+        mask_as_np &= data != 0
 
     # --- Perform morphological closing
 
-    # Find proper element size
-    avg_vox_dim = np.mean(np.absolute((np.array(aff).diagonal())[:-1]))
-    close_element = morph.ball(int(1 / avg_vox_dim))  # Radius approx 1 mm
+    # Find proper element (radius approx 1 mm)
+    close_element = ellipsoid_element(1., aff)
 
     # Perform closing
-    # mask_as_np = morph.closing(mask_as_np, close_element)
+    # mask_as_np = ndimage.binary_closing(mask_as_np, close_element)
 
     # --- Perform dilation (but only CSF) ---
 
@@ -95,48 +104,44 @@ def extract_sulci_fs(seg_paths: dict):
     csf_mask, aff_csf, _ = load_nifti(seg_paths["csf"])
 
     # Translate CSF mask to FreeSurfer arrays
-    aff_translation = (np.linalg.inv(aff_csf)).dot(aff)
-    csf_mask = affine_transform(csf_mask, aff_translation,
-                                output_shape=np.shape(data))
+    csf_mask = resample_to_grid(csf_mask, aff_csf, aff, ribbon_shape)
 
     # Rebinarize csf_mask
-    csf_mask[csf_mask < 0.5 * np.max(csf_mask)] = 0
-    csf_mask[csf_mask >= 0.5 * np.max(csf_mask)] = 1
+    csf_mask = csf_mask >= 0.5 * np.max(csf_mask)
 
-    # Perform dilation
-    dil_element = morph.ball(int(2 / avg_vox_dim))  # Element radius +- 2 mm
-    dilated_mask = morph.dilation(mask_as_np, dil_element)
+    # Perform (binary) dilation
+    dil_element = ellipsoid_element(2., aff)  # Element radius +- 2 mm
+    dilated_mask = ndimage.binary_dilation(mask_as_np, dil_element)
 
     # Delete non-CSF dilation
-    dilated_mask[csf_mask == 0] = 0
+    dilated_mask &= csf_mask
 
     # Append original mask with dilated mask
-    mask_as_np[dilated_mask == 1] = 1
+    mask_as_np |= dilated_mask
+    del csf_mask, dilated_mask
 
     # Remove ventricles
     ventricle_mask, aff_ven, _ = load_nifti(seg_paths["ventricles"])
-    aff_translation = (np.linalg.inv(aff_ven)).dot(aff)
-    ventricle_mask = affine_transform(ventricle_mask, aff_translation,
-                                      output_shape=np.shape(data))
+    ventricle_mask = resample_to_grid(ventricle_mask, aff_ven, aff,
+                                      ribbon_shape)
 
-    mask_as_np[ventricle_mask > 0.5] = 0
+    mask_as_np[ventricle_mask > 0.5] = False
+    del ventricle_mask
 
     # --- Perform final (small) closing ---
 
-    # mask_as_np = morph.closing(mask_as_np, close_element)
+    # mask_as_np = ndimage.binary_closing(mask_as_np, close_element)
 
     # --- Remove mig-saggital area ---
     # We do this by excluding all voxels that are close
     # to both the right and left hemisphere pial surfaces.
 
-    # Create empty mask
-    fs_space_mask, aff_fs, _ = load_nifti(seg_paths["curv_vol"])
-    mid_sag_mask = np.zeros(np.shape(fs_space_mask))
+    # Create empty mask (in the space of the projected curv volume)
+    aff_fs = curv["aff"]
+    mid_sag_mask = np.zeros(ribbon_shape)
 
-    # Extract mgh data
-    with gzip.open(seg_paths["orig_mgh"], 'rb') as mgh_file_handle:
-        mgh_header = \
-            nib.freesurfer.mghformat.MGHHeader.from_fileobj(mgh_file_handle)
+    # Extract mgh header (the volume data itself isn't needed)
+    mgh_header = nib.load(seg_paths["orig_mgh"]).header
 
     # Extract list of vertices on the pial surfaces
     rh_pial_points, _ = \
@@ -144,60 +149,52 @@ def extract_sulci_fs(seg_paths: dict):
     lh_pial_points, _ = \
         nib.freesurfer.read_geometry(seg_paths["lh_pial"])
 
-    # Transform entry point coordinates from RAS to voxel space
+    # Transform pial surface coordinates from RAS to voxel space
+    # (for all vertices at once)
     ras2vox_aff = np.linalg.inv(mgh_header.get_vox2ras_tkr())
+    ras2vox_rot = np.ascontiguousarray(ras2vox_aff[:3, :3].T)
+    ras2vox_trans = ras2vox_aff[:3, 3]
     # Right hemisphere
-    rh_pial_vox = np.zeros(np.shape(rh_pial_points))
-    for i in range(np.shape(rh_pial_vox)[0]):
-        rh_pial_vox[i] = (
-            ras2vox_aff.dot(np.array([*rh_pial_points[i], 1]))
-        )[:-1].astype(int)
+    rh_pial_vox = \
+        (rh_pial_points.dot(ras2vox_rot) + ras2vox_trans).astype(int)
     # Left hemisphere
-    lh_pial_vox = np.zeros(np.shape(lh_pial_points))
-    for i in range(np.shape(lh_pial_vox)[0]):
-        lh_pial_vox[i] = (
-            ras2vox_aff.dot(np.array([*lh_pial_points[i], 1]))
-        )[:-1].astype(int)
+    lh_pial_vox = \
+        (lh_pial_points.dot(ras2vox_rot) + ras2vox_trans).astype(int)
 
     # Create distance-to-surface masks
-    vol_rh = np.zeros(np.shape(mid_sag_mask))
-    vol_lh = np.zeros(np.shape(mid_sag_mask))
+    # (one scratch volume is reused for both hemispheres)
+    surf_vol = np.zeros(ribbon_shape, dtype=bool)
     # Right hemisphere
-    for i in range(np.shape(rh_pial_vox)[0]):
-        indices = rh_pial_vox[i].astype(int)
-        vol_rh[indices[0], indices[1], indices[2]] = 1.0
+    surf_vol[tuple(rh_pial_vox.T)] = True
     dist2surf_rh = generate_distance_map(
-        vol_rh, aff_fs
+        surf_vol, aff_fs
     )
     # Left hemisphere
-    for i in range(np.shape(lh_pial_vox)[0]):
-        indices = lh_pial_vox[i].astype(int)
-        vol_lh[indices[0], indices[1], indices[2]] = 1.0
+    surf_vol[:] = False
+    surf_vol[tuple(lh_pial_vox.T)] = True
     dist2surf_lh = generate_distance_map(
-        vol_lh, aff_fs
+        surf_vol, aff_fs
     )
+    del surf_vol
 
     # Generate mid-saggital area mask
     # Everything close to both the rh and lh edge is deemed
     # mid-saggital plane
-    mid_sag_mask[
-        (dist2surf_rh + dist2surf_lh) < 3.
-    ] = 1.
-
-    # Perform affine transform to subject space
-    if not (aff_fs == aff).all():
-        aff_translation = (np.linalg.inv(aff_fs)).dot(aff)
-        mid_sag_mask = affine_transform(
-            mid_sag_mask, aff_translation,
-            output_shape=np.shape(mask_as_np)
-        )
+    dist2surf_rh += dist2surf_lh
+    del dist2surf_lh
+
+    mid_sag_mask[dist2surf_rh < 3.] = 1.
+    del dist2surf_rh
+
+    # Perform affine transform to subject space (if applicable)
+    mid_sag_mask = resample_to_grid(mid_sag_mask, aff_fs, aff, ribbon_shape)
 
     # Add mid-sag area mask to sulc mask
-    mask_as_np[mid_sag_mask == 1.] = 1.
+    mask_as_np[mid_sag_mask == 1.] = True
 
     # --- Save mask img ---
 
-    mask_img = nib.Nifti1Image(mask_as_np, aff, hdr)
+    mask_img = nib.Nifti1Image(mask_as_np.astype(np.uint8), aff, hdr)
     nib.save(mask_img, seg_paths["sulcus_mask"])
 
 
@@ -219,10 +216,10 @@ def fsl_seg_sulci(paths: dict, settings: dict, verbose: bool = True) \
     for subject, fsl_paths in paths["fsl_paths"].items():
         # Create subject dir and raw subject dir
         subjectDir = os.path.join(paths["segDir"], subject)
-        if not os.path.isdir(subjectDir): os.mkdir(subjectDir)
+        os.makedirs(subjectDir, exist_ok=True)
 
         rawDir = os.path.join(subjectDir, "raw")
-        if not os.path.isdir(rawDir): os.mkdir(rawDir)
+        os.makedirs(rawDir, exist_ok=True)
 
         if subject not in paths["seg_paths"]:
             paths["seg_paths"][subject] = {
@@ -246,16 +243,10 @@ def fsl_seg_sulci(paths: dict, settings: dict, verbose: bool = True) \
         seg_paths.append([subject, t1w_cor_path, csf_pve_path,
                           csf_mask_path, sulcus_mask_path])
 
-    # Now, loop over seg_paths and perform sulcus segmentation
-    # Define iterator
-    if verbose:
-        iterator = tqdm(seg_paths, ascii=True,
-                        bar_format='{l_bar}{bar:30}{r_bar}{bar:-30b}')
-    else:
-        iterator = seg_paths
+    # Now, loop over seg_paths and select the subjects to process
+    jobs = []
 
-    # Main loop
-    for sub_paths in iterator:
+    for sub_paths in seg_paths:
         # Check whether output already there
         csf_mask_ok = os.path.exists(sub_paths[3])
         sul_mask_ok = os.path.exists(sub_paths[4])
@@ -268,14 +259,17 @@ def fsl_seg_sulci(paths: dict, settings: dict, verbose: bool = True) \
                 continue
             elif settings["resetModules"][2] == 1:
                 # Generate sulcus mask
-                extract_sulci_fsl(sub_paths[1], sub_paths[3], sub_paths[4])
+                jobs.append((sub_paths[1], sub_paths[3], sub_paths[4]))
             else:
                 raise ValueError("Parameter 'resetModules' should be a list "
                                  "containing only 0's and 1's. "
                                  "Please check the config file (config.json).")
         else:
             # Generate sulcus mask
-            extract_sulci_fsl(sub_paths[1], sub_paths[3], sub_paths[4])
+            jobs.append((sub_paths[1], sub_paths[3], sub_paths[4]))
+
+    # Perform sulcus segmentation (subjects in parallel)
+    run_parallel(extract_sulci_fsl, jobs, verbose, settings["maxWorkers"])
 
     return paths, settings, skipped_img
 
@@ -298,10 +292,10 @@ def fs_seg_sulci(paths: dict, settings: dict, verbose: bool = True) \
     for subject, fs_path in paths["fs_paths"].items():
         # Create subject dir and raw subject dir
         subjectDir = os.path.join(paths["segDir"], subject)
-        if not os.path.isdir(subjectDir): os.mkdir(subjectDir)
+        os.makedirs(subjectDir, exist_ok=True)
 
         rawDir = os.path.join(subjectDir, "raw")
-        if not os.path.isdir(rawDir): os.mkdir(rawDir)
+        os.makedirs(rawDir, exist_ok=True)
 
         if subject not in paths["seg_paths"]:
             paths["seg_paths"][subject] = {
@@ -356,16 +350,10 @@ def fs_seg_sulci(paths: dict, settings: dict, verbose: bool = True) \
 
         seg_paths.append(subject_dict)
 
-    # Now, loop over seg_paths and perform ventricle segmentation
-    # Define iterator
-    if verbose:
-        iterator = tqdm(seg_paths, ascii=True,
-                        bar_format='{l_bar}{bar:30}{r_bar}{bar:-30b}')
-    else:
-        iterator = seg_paths
+    # Now, loop over seg_paths and select the subjects to process
+    jobs = []
 
-    # Main loop
-    for sub_paths in iterator:
+    for sub_paths in seg_paths:
         # Check whether output already there
         output_ok = os.path.exists(sub_paths["sulcus_mask"])
 
@@ -376,14 +364,17 @@ def fs_seg_sulci(paths: dict, settings: dict, verbose: bool = True) \
                 continue
             elif settings["resetModules"][2] == 1:
                 # Generate sulcus mask
-                extract_sulci_fs(sub_paths)
+                jobs.append((sub_paths,))
             else:
                 raise ValueError("Parameter 'resetModules' should be a list "
                                  "containing only 0's and 1's. "
                                  "Please check the config file (config.json).")
         else:
             # Generate sulcus mask
-            extract_sulci_fs(sub_paths)
+            jobs.append((sub_paths,))
+
+    # Perform sulcus segmentation (subjects in parallel)
+    run_parallel(extract_sulci_fs, jobs, verbose, settings["maxWorkers"])
 
     return paths, settings, skipped_img
 
@@ -404,7 +395,7 @@ def seg_sulci(paths: dict, settings: dict, verbose: bool = True) \
     if "seg_paths" not in paths:
         paths["seg_paths"] = {}
 
-    if not os.path.isdir(paths["segDir"]): os.mkdir(paths["segDir"])
+    os.makedirs(paths["segDir"], exist_ok=True)
 
     # Perform the actual ventricle extraction in one of two modes
     if settings["quick_and_dirty"] == 1:
@@ -3,156 +3,211 @@
 import os
 import nibabel as nib
 import numpy as np
-import skimage.morphology as morph
+from scipy import ndimage
 from typing import Union
-from shutil import copyfile
-from tqdm import tqdm
-from seg.mask_util import find_center, binarize_mask
+from seg.mask_util import find_center, binarize_mask, ball_element
 from util.nifti import load_nifti
-from util.freesurfer import extract_tissues, mgz2nii
+from util.freesurfer import mgz2nii
+from util.general import check_up_to_date, link_or_copy, run_parallel
 
 
-def find_seed_mask(csf_mask: np.ndarray, img_aff: np.ndarray,
+def find_seed_mask(csf_mask: np.ndarray, avg_vox_dim: float,
                    center_coords: Union[tuple, list]) -> np.ndarray:
     """
     This function finds seed points for the ventricles.
     These may later be used for the region growing algorithm.
+    The avg_vox_dim parameter is the average voxel dimension in [mm].
     """
 
     # Initialize seed_mask
     seed_mask = csf_mask
 
-    # Determine avg voxel dimension
-    avg_vox_dim = np.mean(np.absolute((np.array(img_aff).diagonal())[:-1]))
-
     # Perform erosion with a ball element (radius approx 4mm)
-    element = morph.ball(int(4 / avg_vox_dim))
-    seed_mask = morph.erosion(seed_mask, element)
+    # (the border is treated as foreground, as in a greyscale erosion)
+    element = ball_element(int(4 / avg_vox_dim))
+    seed_mask = ndimage.binary_erosion(seed_mask.astype(bool, copy=False),
+                                       element, border_value=1)
+
+    # Find bounding box of the region "near the brain's center" (<20mm)
+    radius = 20 / avg_vox_dim
+    box = tuple(
+        slice(max(int(np.floor(center_coords[i] - radius)), 0),
+              min(int(np.ceil(center_coords[i] + radius)) + 1,
+                  np.shape(seed_mask)[i]))
+        for i in range(3)
+    )
 
-    # Find mask for "near the brain's center"
-    xx, yy, zz = np.meshgrid(np.arange(np.shape(seed_mask)[0]),
-                             np.arange(np.shape(seed_mask)[1]),
-                             np.arange(np.shape(seed_mask)[2]),
-                             indexing="ij")
+    # Find mask for "near the brain's center" within this box
+    xx, yy, zz = np.ogrid[box]
 
-    xx_offset = xx - center_coords[0]
-    yy_offset = yy - center_coords[1]
-    zz_offset = zz - center_coords[2]
-    dist2center = np.sqrt(xx_offset ** 2 + yy_offset ** 2 + zz_offset ** 2)
+    dist2center_sq = (xx - center_coords[0]) ** 2 + \
+        (yy - center_coords[1]) ** 2 + \
+        (zz - center_coords[2]) ** 2
 
-    center_mask = np.zeros(np.shape(seed_mask))
-    center_mask[dist2center < 20 / avg_vox_dim] = 1  # <20mm from the center
+    center_mask = dist2center_sq < radius ** 2
 
     # Remove seed points that are too far from the center
-    seed_mask = seed_mask * center_mask
+    seed_mask_box = seed_mask[box] & center_mask
+    seed_mask = np.zeros(np.shape(seed_mask), dtype=bool)
+    seed_mask[box] = seed_mask_box
 
     return seed_mask
 
 
 def region_growing(seed_mask: np.ndarray, full_mask: np.ndarray,
-                   img_aff: np.ndarray, element_size: int = 2) -> np.ndarray:
+                   avg_vox_dim: float, element_size: int = 2) -> np.ndarray:
     """
     This function performs a region growing algorithm.
     It makes use of a seed mask and a full mask.
     - The seed masks contains several voxels in the ROI (e.g. ventricles).
     - The full mask contains all voxels of the tissue of interest (e.g. CSF).
-    - The img_aff parameter contains the affine transformation to real space.
+    - The avg_vox_dim parameter is the average voxel dimension in [mm].
     - The element_size parameter is the element size (radius) in [mm].
+    The crude region growing step is limited to 51 dilations,
+    while the fine step runs until convergence.
     """
 
-    # Determine avg voxel dimension
-    avg_vox_dim = np.mean(np.absolute((np.array(img_aff).diagonal())[:-1]))
-
     # Build morphological structuring element
-    element = morph.ball(int(element_size / avg_vox_dim))
-    big_element = morph.ball(int(element_size * 1.5 / avg_vox_dim))
-    small_element = morph.ball(1)
-
-    # Perform openings of full mask
-    crude_mask = full_mask
-    crude_mask = morph.opening(crude_mask, big_element)
-    full_mask = morph.opening(full_mask, element)
-
-    # Perform crude region growing loop
-    stop_loop = False
-    previous_output = seed_mask
-    new_output = seed_mask
-    loop_n = 0
-    while not stop_loop:
-        # Update input and loop count
-        loop_n += 1
-        new_input = previous_output
-
-        # Perform region growing
-        new_output = morph.dilation(new_input, element)
-        new_output = new_output * crude_mask
+    element = ball_element(int(element_size / avg_vox_dim))
+    big_element = ball_element(int(element_size * 1.5 / avg_vox_dim))
+    small_element = ndimage.generate_binary_structure(3, 1)
 
-        # Check whether loop should stop
-        stop_loop = (previous_output == new_output).all() or (loop_n > 50)
+    # Find bounding box of the full mask. Nothing can grow outside of it,
+    # so we only process this box (plus a margin for the seed dilation).
+    full_mask = full_mask.astype(bool, copy=False)
+    seed_mask = seed_mask.astype(bool, copy=False)
+    processed_mask = np.zeros(np.shape(full_mask), dtype=bool)
 
-        # Update output var
-        previous_output = new_output
+    bbox = ndimage.find_objects(full_mask.astype(np.uint8))
+    if not bbox: return processed_mask
 
-    # Perform fine region growing loop
-    stop_loop = False
-    loop_n = 0
-    while not stop_loop:
-        new_input = previous_output
+    margin = max(np.shape(element)[0], np.shape(big_element)[0]) // 2
+    box = tuple(slice(max(sl.start - margin, 0),
+                      min(sl.stop + margin, np.shape(full_mask)[i]))
+                for i, sl in enumerate(bbox[0]))
 
-        # Perform region growing
-        new_output = morph.dilation(new_input, small_element)
-        new_output = new_output * full_mask
+    full_mask = full_mask[box]
+    seed_mask = seed_mask[box]
 
-        # Check whether loop should stop
-        stop_loop = (previous_output == new_output).all() or (loop_n > 5)
-
-        # Update output var
-        previous_output = new_output
-
-    # Store and return final result
-    processed_mask = new_output
+    # Perform openings of full mask
+    # (greyscale openings, which mirror the mask at the volume border,
+    # as opposed to scipy's binary opening that pads it with zeros)
+    crude_mask = ndimage.grey_opening(full_mask.view(np.uint8),
+                                      footprint=big_element).view(bool)
+    full_mask = ndimage.grey_opening(full_mask.view(np.uint8),
+                                     footprint=element).view(bool)
+
+    # Perform crude region growing (max. 51 iterations)
+    # The dilation is constrained to the crude mask within scipy's
+    # (binary) dilation itself, which also stops at convergence.
+    crude_output = ndimage.binary_dilation(
+        seed_mask, element, iterations=51, mask=crude_mask
+    ) & crude_mask
+
+    # Perform fine region growing (until convergence)
+    fine_output = ndimage.binary_dilation(
+        crude_output, small_element, iterations=-1, mask=full_mask
+    ) & full_mask
+
+    # Store and return final result (pasted back into the full volume)
+    processed_mask[box] = fine_output
 
     return processed_mask
 
 
-def extract_ventricles_fsl(bet_img_path: str, csf_mask_path: str,
+def extract_ventricles_fsl(bet_img_path: str, csf_mask: np.ndarray,
                            ventricles_mask_path: str):
     """
     This function extracts the ventricles from a CSF mask.
     It uses some morphological tricks for this purpose.
+    The CSF mask is passed as an array, which should be defined
+    on the same voxel grid as the BET image.
     """
 
-    # Extract image, csf mask
-    bet_img, img_aff, img_hdr = load_nifti(bet_img_path)
-    csf_mask, _, _ = load_nifti(csf_mask_path)
+    # Extract image
+    # (the BET image is only used to find the brain's center,
+    # so single precision suffices here)
+    bet_img, img_aff, img_hdr = load_nifti(bet_img_path, dtype=np.float32)
+
+    # Work on a boolean CSF mask from here on
+    csf_mask = csf_mask.astype(bool, copy=False)
+
+    # Determine avg voxel dimension
+    avg_vox_dim = np.mean(np.absolute(img_aff.diagonal()[:-1]))
 
     # Find the center of the brain
     center_coords = find_center(bet_img)
 
     # Find seed mask for ventricles
-    seed_mask = find_seed_mask(csf_mask, img_aff, center_coords)
+    seed_mask = find_seed_mask(csf_mask, avg_vox_dim, center_coords)
 
     # Perform region growing
-    ventricle_mask = region_growing(seed_mask, csf_mask, img_aff)
+    ventricle_mask = region_growing(seed_mask, csf_mask, avg_vox_dim)
 
     # Save ventricle mask
-    nii_mask = nib.Nifti1Image(ventricle_mask, img_aff, img_hdr)
+    nii_mask = nib.Nifti1Image(ventricle_mask.astype(np.uint8),
+                               img_aff, img_hdr)
+    nii_mask.set_data_dtype(np.uint8)
     nib.save(nii_mask, ventricles_mask_path)
 
 
 def extract_ventricles_fs(aparc_aseg_path: str, ventricles_mask_path: str):
     """
     This function extracts the ventricles from FreeSurfer output.
-    We simply extract the appropriate label and perform some
-    file format conversions for this purpose.
-    aparc_aseg_path      --> path to aparc+aseg.mgz file
+    We simply extract the appropriate labels from the (converted)
+    aparc+aseg volume for this purpose.
+    aparc_aseg_path      --> path to aparc+aseg .nii file
     ventricles_mask_path --> path to to-be-created ventricles .nii mask.
     """
 
     # Define FreeSurfer labels
     ventricle_labels = [4, 5, 43, 44]
+
+    # Load label volume (keep the integer labels as-is)
+    label_img = nib.load(aparc_aseg_path)
+    labels = np.asanyarray(label_img.dataobj)
+
     # Label the appropriate voxels
-    extract_tissues(aparc_aseg_path, ventricles_mask_path, ventricle_labels)
+    ventricle_mask = np.isin(labels, ventricle_labels).astype(np.uint8)
+
+    # Save ventricle mask
+    nii_mask = nib.Nifti1Image(ventricle_mask, label_img.affine,
+                               label_img.header)
+    nii_mask.set_data_dtype(np.uint8)
+    nib.save(nii_mask, ventricles_mask_path)
+
+
+def segment_ventricles_fsl(sub_paths: list):
+    """
+    This function performs the quick and dirty ventricle segmentation
+    of a single subject. It binarizes the CSF pve map and calls upon
+    extract_ventricles_fsl() to generate the ventricle mask.
+    This allows it to be run in a separate (worker) process.
+    """
+
+    # Binarize the pve map to a 0/1 mask
+    csf_mask = binarize_mask(sub_paths[2], sub_paths[3], treshold=0.8)
+    # Generate ventricle mask (from the in-memory CSF mask)
+    extract_ventricles_fsl(sub_paths[1], csf_mask, sub_paths[4])
+
+
+def segment_ventricles_fs(sub_paths: list):
+    """
+    This function performs the FreeSurfer-based ventricle segmentation
+    of a single subject. It performs the needed file conversions and
+    calls upon extract_ventricles_fs() to generate the ventricle mask.
+    This allows it to be run in a separate (worker) process.
+    """
+
+    # Perform some file structure changes (if not up-to-date).
+    if not check_up_to_date(sub_paths[1], sub_paths[3]):
+        mgz2nii(sub_paths[1], sub_paths[3])   # t1 (mgz-->nii)
+    if not check_up_to_date(sub_paths[2], sub_paths[4]):
+        mgz2nii(sub_paths[2], sub_paths[4])   # labels (mgz-->nii)
+    if not check_up_to_date(sub_paths[4], sub_paths[5]):
+        link_or_copy(sub_paths[4], sub_paths[5])  # labels (fs-->seg)
+    # Generate ventricle mask (from the converted label volume)
+    extract_ventricles_fs(sub_paths[5], sub_paths[6])
 
 
 def fsl_seg_ventricles(paths: dict, settings: dict, verbose: bool = True) \
@@ -173,10 +228,10 @@ def fsl_seg_ventricles(paths: dict, settings: dict, verbose: bool = True) \
     for subject, fsl_paths in paths["fsl_paths"].items():
         # Create subject dir and raw subject dir
         subjectDir = os.path.join(paths["segDir"], subject)
-        if not os.path.isdir(subjectDir): os.mkdir(subjectDir)
+        os.makedirs(subjectDir, exist_ok=True)
 
         rawDir = os.path.join(subjectDir, "raw")
-        if not os.path.isdir(rawDir): os.mkdir(rawDir)
+        os.makedirs(rawDir, exist_ok=True)
 
         if subject not in paths["seg_paths"]:
             paths["seg_paths"][subject] = {
@@ -200,41 +255,32 @@ def fsl_seg_ventricles(paths: dict, settings: dict, verbose: bool = True) \
         seg_paths.append([subject, t1w_cor_path, csf_pve_path,
                           csf_mask_path, ventricle_mask_path])
 
-    # Now, loop over seg_paths and perform ventricle segmentation
-    # Define iterator
-    if verbose:
-        iterator = tqdm(seg_paths, ascii=True,
-                        bar_format='{l_bar}{bar:30}{r_bar}{bar:-30b}')
-    else:
-        iterator = seg_paths
+    # Check reset parameter (once)
+    reset = settings["resetModules"][2]
+    if reset not in [0, 1]:
+        raise ValueError("Parameter 'resetModules' should be a list "
+                         "containing only 0's and 1's. "
+                         "Please check the config file (config.json).")
 
-    # Main loop
-    for sub_paths in iterator:
+    # Now, loop over seg_paths and select the subjects to process
+    jobs = []
+
+    for sub_paths in seg_paths:
         # Check whether output already there
         csf_mask_ok = os.path.exists(sub_paths[3])
         ven_mask_ok = os.path.exists(sub_paths[4])
         output_ok = (csf_mask_ok and ven_mask_ok)
 
         # Determine whether to skip subject
-        if output_ok:
-            if settings["resetModules"][2] == 0:
-                skipped_img = True
-                continue
-            elif settings["resetModules"][2] == 1:
-                # Binarize the pve map to a 0/1 mask
-                binarize_mask(sub_paths[2], sub_paths[3], treshold=0.8)
-                # Generate ventricle mask
-                extract_ventricles_fsl(sub_paths[1], sub_paths[3],
-                                       sub_paths[4])
-            else:
-                raise ValueError("Parameter 'resetModules' should be a list "
-                                 "containing only 0's and 1's. "
-                                 "Please check the config file (config.json).")
-        else:
-            # Binarize the pve map to a 0/1 mask
-            binarize_mask(sub_paths[2], sub_paths[3], treshold=0.8)
-            # Generate ventricle mask
-            extract_ventricles_fsl(sub_paths[1], sub_paths[3], sub_paths[4])
+        if output_ok and reset == 0:
+            skipped_img = True
+            continue
+
+        # Generate ventricle mask
+        jobs.append((sub_paths,))
+
+    # Perform ventricle segmentation (subjects in parallel)
+    run_parallel(segment_ventricles_fsl, jobs, verbose, settings["maxWorkers"])
 
     return paths, settings, skipped_img
 
@@ -257,10 +303,10 @@ def fs_seg_ventricles(paths: dict, settings: dict, verbose: bool = True) \
     for subject, fs_path in paths["fs_paths"].items():
         # Create subject dir and raw subject dir
         subjectDir = os.path.join(paths["segDir"], subject)
-        if not os.path.isdir(subjectDir): os.mkdir(subjectDir)
+        os.makedirs(subjectDir, exist_ok=True)
 
         rawDir = os.path.join(subjectDir, "raw")
-        if not os.path.isdir(rawDir): os.mkdir(rawDir)
+        os.makedirs(rawDir, exist_ok=True)
 
         if subject not in paths["seg_paths"]:
             paths["seg_paths"][subject] = {
@@ -276,8 +322,7 @@ def fs_seg_ventricles(paths: dict, settings: dict, verbose: bool = True) \
         t1w_nii_path = os.path.join(fs_path, "nifti", "T1.nii.gz")
         label_nii_path = os.path.join(fs_path, "nifti", "aparc+aseg.nii.gz")
 
-        if not os.path.isdir(os.path.join(fs_path, "nifti")):
-            os.mkdir(os.path.join(fs_path, "nifti"))
+        os.makedirs(os.path.join(fs_path, "nifti"), exist_ok=True)
 
         # Assemble segmentation path
         label_seg_path = os.path.join(rawDir, "fs_aparc+aseg.nii.gz")
@@ -292,44 +337,32 @@ def fs_seg_ventricles(paths: dict, settings: dict, verbose: bool = True) \
                           t1w_nii_path, label_nii_path, label_seg_path,
                           ventricle_mask_path])
 
-    # Now, loop over seg_paths and perform ventricle segmentation
-    # Define iterator
-    if verbose:
-        iterator = tqdm(seg_paths, ascii=True,
-                        bar_format='{l_bar}{bar:30}{r_bar}{bar:-30b}')
-    else:
-        iterator = seg_paths
+    # Check reset parameter (once)
+    reset = settings["resetModules"][2]
+    if reset not in [0, 1]:
+        raise ValueError("Parameter 'resetModules' should be a list "
+                         "containing only 0's and 1's. "
+                         "Please check the config file (config.json).")
+
+    # Now, loop over seg_paths and select the subjects to process
+    jobs = []
 
-    # Main loop
-    for sub_paths in iterator:
+    for sub_paths in seg_paths:
         # Check whether output already there
         fs_label_ok = os.path.exists(sub_paths[5])
         ven_mask_ok = os.path.exists(sub_paths[6])
         output_ok = (fs_label_ok and ven_mask_ok)
 
         # Determine whether to skip subject
-        if output_ok:
-            if settings["resetModules"][2] == 0:
-                skipped_img = True
-                continue
-            elif settings["resetModules"][2] == 1:
-                # Perform some file structure changes.
-                mgz2nii(sub_paths[1], sub_paths[3])   # t1 (mgz-->nii)
-                mgz2nii(sub_paths[2], sub_paths[4])   # aparc+aseg (mgz-->nii)
-                copyfile(sub_paths[4], sub_paths[5])  # aparc+aseg (fs-->seg)
-                # Generate ventricle mask
-                extract_ventricles_fs(sub_paths[2], sub_paths[6])
-            else:
-                raise ValueError("Parameter 'resetModules' should be a list "
-                                 "containing only 0's and 1's. "
-                                 "Please check the config file (config.json).")
-        else:
-            # Perform some file structure changes.
-            mgz2nii(sub_paths[1], sub_paths[3])       # t1 (mgz-->nii)
-            mgz2nii(sub_paths[2], sub_paths[4])       # aparc+aseg (mgz-->nii)
-            copyfile(sub_paths[4], sub_paths[5])      # aparc+aseg (fs-->seg)
-            # Generate ventricle mask
-            extract_ventricles_fs(sub_paths[2], sub_paths[6])
+        if output_ok and reset == 0:
+            skipped_img = True
+            continue
+
+        # Generate ventricle mask
+        jobs.append((sub_paths,))
+
+    # Perform ventricle segmentation (subjects in parallel)
+    run_parallel(segment_ventricles_fs, jobs, verbose, settings["maxWorkers"])
 
     return paths, settings, skipped_img
 
@@ -353,7 +386,7 @@ def seg_ventricles(paths: dict, settings: dict, verbose: bool = True) \
     if "seg_paths" not in paths:
         paths["seg_paths"] = {}
 
-    if not os.path.isdir(paths["segDir"]): os.mkdir(paths["segDir"])
+    os.makedirs(paths["segDir"], exist_ok=True)
 
     # Perform the actual ventricle extraction in one of two modes
     if settings["quick_and_dirty"] == 1:
@@ -2,30 +2,62 @@
 
 import os
 from typing import Optional
+from concurrent.futures import Future, ThreadPoolExecutor
 import itk
 import numpy as np
 import nibabel as nib
-import skimage.morphology as morph
-from tqdm import tqdm
-from scipy.ndimage import affine_transform
-from util.nifti import load_nifti
+from util.nifti import load_nifti, resample_to_grid
+from util.general import count_workers, run_parallel
+from seg.mask_util import ball_element, closing
+
+# ITK types used throughout this module (3D, float images).
+# These are instantiated once here, instead of on every function call.
+ImageType = itk.Image[itk.F, 3]
+HessianPixelType = itk.SymmetricSecondRankTensor[itk.D, 3]
+HessianImageType = itk.Image[HessianPixelType, 3]
+NodeType = itk.LevelSetNode.F3
+NodeContainerType = itk.VectorContainer[itk.UI, NodeType]
 
 
 def backup_result(image: itk.Image, aff: np.ndarray,
-                  nii_header: nib.nifti1.Nifti1Header, filename: str):
+                  nii_header: nib.nifti1.Nifti1Header, filename: str,
+                  dtype: type = np.float32,
+                  pool: Optional[ThreadPoolExecutor] = None) \
+        -> Optional[Future]:
     """
     This function may be used to back-up intermediate results
     of the segmentation processing pipeline.
+    The image is stored as 'dtype' (np.uint8 may be used for masks).
+    If a thread pool is given, the image is written in the background
+    (nibabel releases the GIL while compressing) and the corresponding
+    future is returned. Use wait_for_backups() to make sure it's on disk.
+    The image data is copied first, so the image may change meanwhile.
     """
 
-    # Create nibabel image object
-    nii_backup = nib.Nifti1Image(
-        np.moveaxis(np.asarray(image), [0, 1, 2], [2, 1, 0]),
-        aff, nii_header
-    )
+    # Copy the ITK buffer (transposed to nifti axes) and cast if needed
+    image_np = itk.array_from_image(image).transpose(2, 1, 0)
+    image_np = image_np.astype(dtype, copy=False)
+
+    # Create nibabel image object (stored as dtype)
+    nii_backup = nib.Nifti1Image(image_np, aff, nii_header)
+    nii_backup.set_data_dtype(dtype)
+
+    # Save image (if applicable, in the background)
+    if pool is None:
+        nib.save(nii_backup, filename)
+        return None
+    else:
+        return pool.submit(nib.save, nii_backup, filename)
+
+
+def wait_for_backups(backups: list):
+    """
+    This function waits for all given (background) back-ups
+    to be written. Errors raised while saving are re-raised here.
+    """
 
-    # Save image
-    nib.save(nii_backup, filename)
+    for backup in backups:
+        if backup is not None: backup.result()
 
 
 def determine_intensity_sigmoid_params(
@@ -39,17 +71,19 @@ def determine_intensity_sigmoid_params(
     a fast marching algorithm.
     """
 
-    # Import images to numpy
-    intensity_array = np.asarray(intensity_image)
-    mask_array = np.asarray(vessel_mask)
+    # Import images to numpy (as views, without copying)
+    intensity_array = itk.array_view_from_image(intensity_image)
+    mask_array = itk.array_view_from_image(vessel_mask)
 
-    # Obtain intensity values for vessel and non-vessel
-    vessel_array = intensity_array[mask_array != 0.0]
-    nonvessel_array = intensity_array[mask_array == 0.0]
+    # Obtain masks for vessel and (nonzero) non-vessel voxels
+    vessel_mask = mask_array != 0.0
+    nonvessel_mask = ~vessel_mask
+    nonvessel_mask &= intensity_array != 0.0
 
     # Calculate average intensities for vessel and non-vessel
-    K1 = np.mean(vessel_array)
-    K2 = np.mean(nonvessel_array[nonvessel_array != 0.0])
+    # (reduced in-place, without copying the selected values)
+    K1 = np.mean(intensity_array, dtype=np.float64, where=vessel_mask)
+    K2 = np.mean(intensity_array, dtype=np.float64, where=nonvessel_mask)
 
     # Calculate alpha and beta
     alpha = (K1 - K2) / 6
@@ -67,12 +101,11 @@ def determine_edge_sigmoid_params(laplacian_image: itk.Image) \
     with high intensity gradients to 0.0.
     """
 
-    # Import image to numpy
-    image_array = np.asarray(laplacian_image)
+    # Import image to numpy (as view, without copying)
+    image_array = itk.array_view_from_image(laplacian_image)
 
-    # Obtain max and min values
-    max_edgeness = np.percentile(image_array, 95)
-    min_edgeness = np.percentile(image_array, 5)
+    # Obtain max and min values (in a single partitioning pass)
+    min_edgeness, max_edgeness = np.percentile(image_array, [5, 95])
 
     # Calculate average intensities for vessel and non-vessel
     K1 = min_edgeness
@@ -99,19 +132,11 @@ def anisotropic_diffusion_smoothing(image: itk.Image,
     # Cast image to itk.F
     image_F = image.astype(itk.F)
 
-    # Setup image parameters
-    InputPixelType = itk.F
-    OutputPixelType = itk.F
-    Dimension = image.GetImageDimension()
-
-    InputImageType = itk.Image[InputPixelType, Dimension]
-    OutputImageType = itk.Image[OutputPixelType, Dimension]
-
     # Perform filtering
     smoothed_img = itk.curvature_anisotropic_diffusion_image_filter(
         image_F, number_of_iterations=nIter, time_step=timeStep,
         conductance_parameter=conductance,
-        ttype=[InputImageType, OutputImageType]
+        ttype=[ImageType, ImageType]
     )
 
     return smoothed_img
@@ -132,20 +157,10 @@ def hessian_vesselness(image: itk.Image, voxDim: float,
     # Cast image to itk.F
     image_F = image.astype(itk.F)
 
-    # Setup image parameters
-    PixelType = itk.F
-    Dimension = image_F.GetImageDimension()
-
-    ImageType = itk.Image[PixelType, Dimension]
-
     # Set-up parameters
     sigmaMin = sigmaRange[0] / voxDim
     sigmaMax = sigmaRange[1] / voxDim
 
-    # Set-up Hessian image type
-    HessianPixelType = itk.SymmetricSecondRankTensor[itk.D, Dimension]
-    HessianImageType = itk.Image[HessianPixelType, Dimension]
-
     # Set-up Hessian-to-objectness filter
     objectness_filter = itk.HessianToObjectnessMeasureImageFilter[
         HessianImageType, ImageType].New()
@@ -178,9 +193,8 @@ def vesselness_thresholding(image: itk.Image, percentile: float = 95.,
     The threshold is set to a certain percentile (param)
     """
 
-    # Import vesselness image to numpy
-    vesselness_as_np = itk.array_from_image(image)
-    np.moveaxis(vesselness_as_np, [0, 1, 2], [2, 1, 0])
+    # Import vesselness image to numpy (as view, without copying)
+    vesselness_as_np = itk.array_view_from_image(image)
 
     # Determine threshold
     if nonzeros:
@@ -190,12 +204,14 @@ def vesselness_thresholding(image: itk.Image, percentile: float = 95.,
     else:
         abs_threshold = np.percentile(vesselness_as_np, percentile)
 
-    # Threshold image
-    vesselness_as_np[vesselness_as_np < abs_threshold] = 0.
-    vesselness_as_np[vesselness_as_np >= abs_threshold] = 1.
+    # Threshold image (stored as uint8, the mask is only used
+    # for its nonzero voxels downstream)
+    thresholded_as_np = \
+        (vesselness_as_np >= abs_threshold).view(np.uint8)
 
-    # Export vesselness image back to itk
-    image_out = itk.image_from_array(vesselness_as_np)
+    # Export thresholded image back to itk
+    # (as a view, the image keeps a reference to the numpy buffer)
+    image_out = itk.image_view_from_array(thresholded_as_np)
 
     return image_out
 
@@ -212,19 +228,24 @@ def fastmarching_segmentation(image: itk.Image, seed_mask: itk.Image,
                               stoppingTime: int = 10,
                               smoothInput: bool = False,
                               useOnlyGradientMagnitudeAsSpeed: bool = False,
-                              backupInterResults: bool = True) -> itk.Image:
+                              backupInterResults: bool = True,
+                              backupPool: Optional[ThreadPoolExecutor] = None
+                              ) -> itk.Image:
     """
     Here, we implement the fastmarching segmentation (ITK),
     as is documented (for C++) at:
     https://itk.org/Doxygen/html/itkFastMarchingImageFilter_8h_source.html
+    If a thread pool is given, the back-ups are written in the background.
     """
 
+    # Initialize list of (background) back-ups
+    backups = []
+
     # Determine voxel size
     avg_vox_dim = np.mean(np.absolute((affine_matrix.diagonal())[:-1]))
 
     # Cast image to itk.F
     image_F = image.astype(itk.F)
-    ImageType = itk.Image[itk.F, image.GetImageDimension()]
 
     # If applicable, apply smoothing to input
     if smoothInput:
@@ -239,8 +260,11 @@ def fastmarching_segmentation(image: itk.Image, seed_mask: itk.Image,
         )
 
     if backupInterResults:
-        backup_result(laplacianEdge_image, affine_matrix, nii_header,
-                      os.path.join(logsDir, "4_1_gradient_magnitude.nii.gz"))
+        backups.append(backup_result(
+            laplacianEdge_image, affine_matrix, nii_header,
+            os.path.join(logsDir, "4_1_gradient_magnitude.nii.gz"),
+            pool=backupPool
+        ))
 
     # Calculate speed map by applying sigmoid filter to gradMag-image
     # and intensity image
@@ -281,38 +305,44 @@ def fastmarching_segmentation(image: itk.Image, seed_mask: itk.Image,
         )
 
     # Set speed in non-brain to 0
-    speedMap_np = np.asarray(speedMap_image)
-    image_np = np.asarray(image_F)
-
-    speedMap_np[image_np < 1e-2 * np.mean(image_np)] = 0.
+    # We do this in-place, on a view of the (disconnected) speed map
+    speedMap_image.DisconnectPipeline()
+    speedMap_np = itk.array_view_from_image(speedMap_image)
+    image_np = itk.array_view_from_image(image_F)
 
-    speedMap_image = itk.GetImageFromArray(speedMap_np)
+    brain_threshold = 1e-2 * np.mean(image_np)
+    np.copyto(speedMap_np, 0., where=image_np < brain_threshold)
 
     if backupInterResults:
-        backup_result(speedMap_image, affine_matrix, nii_header,
-                      os.path.join(logsDir, "4_2_speed_map_sigmoid.nii.gz"))
+        backups.append(backup_result(
+            speedMap_image, affine_matrix, nii_header,
+            os.path.join(logsDir, "4_2_speed_map_sigmoid.nii.gz"),
+            pool=backupPool
+        ))
 
     # Generate appropriate seed mask format (image to list of points)
     if backupInterResults:
-        backup_result(seed_mask, affine_matrix, nii_header,
-                      os.path.join(logsDir, "4_3_seed_mask.nii.gz"))
-
-    seed_idx = np.nonzero(np.asarray(seed_mask))
-
-    NodeType = itk.LevelSetNode.F3
-    NodeContainer = itk.VectorContainer[itk.UI, NodeType]
-    SeedPoints = NodeContainer.New()
+        backups.append(backup_result(
+            seed_mask, affine_matrix, nii_header,
+            os.path.join(logsDir, "4_3_seed_mask.nii.gz"),
+            dtype=np.uint8, pool=backupPool
+        ))
+
+    # Seed indices as (N, 3) list, in ITK's (x, y, z) order
+    # (converted to Python ints in one go, instead of per coordinate)
+    seed_idx = \
+        np.argwhere(itk.array_view_from_image(seed_mask))[:, ::-1].tolist()
+
+    SeedPoints = NodeContainerType.New()
     SeedPoints.Initialize()
+    SeedPoints.Reserve(len(seed_idx))
 
-    for i in range(np.shape(seed_idx)[1]):
-        id_x = int(seed_idx[2][i])
-        id_y = int(seed_idx[1][i])
-        id_z = int(seed_idx[0][i])
-
-        node = NodeType()
-        node.SetIndex((id_x, id_y, id_z))
-        node.SetValue(0.0)
+    # The container stores copies, so we may reuse a single node
+    node = NodeType()
+    node.SetValue(0.0)
 
+    for i, seed_index in enumerate(seed_idx):
+        node.SetIndex(seed_index)
         SeedPoints.InsertElement(i, node)
 
     # Perform FastMarching
@@ -331,6 +361,9 @@ def fastmarching_segmentation(image: itk.Image, seed_mask: itk.Image,
         outside_value=0.0, inside_value=1.0
     )
 
+    # Make sure all back-ups are written
+    wait_for_backups(backups)
+
     return image_out, laplacianSigmoid_image
 
 
@@ -373,7 +406,8 @@ def levelset_segmentation(seed_image: itk.Image,
 def neumann_segmentation(image: np.ndarray,
                          affine_matrix: np.ndarray,
                          nii_header: nib.nifti1.Nifti1Header,
-                         logsDir: str) -> np.ndarray:
+                         logsDir: str,
+                         backupInterResults: bool = True) -> np.ndarray:
     """
     This function implements the *LevelSet* vessel segmentation
     method, as is described by Neumann et al., 2019
@@ -391,109 +425,150 @@ def neumann_segmentation(image: np.ndarray,
     - Now, we finally implement an active contour segmentation algorithm
       we call the LevelSet step. This step extends the segmentation map
       found with the FastMarching method to append some of the smaller details.
+    If 'backupInterResults' is set, the intermediate results are
+    backed up to 'logsDir'.
     """
 
     # Determine image scale
     avg_vox_dim = np.mean(np.absolute((affine_matrix.diagonal())[:-1]))
 
     # Import image to itk
-    img_itk = (itk.GetImageFromArray(image))
-    image_in = img_itk.astype(itk.F)
-
-    # --- Anisotropic diffusion smoothing ---
-
-    # Apply filter
-    smoothed_img = anisotropic_diffusion_smoothing(image_in)
-    # Backup image
-    backup_result(smoothed_img, affine_matrix, nii_header,
-                  os.path.join(logsDir, "1_anisotropic_diff_smoothing.nii.gz"))
-
-    # --- Hessian-based vesselness map ---
-
-    # Apply filter
-    vesselness_img = hessian_vesselness(smoothed_img, avg_vox_dim)
-    # Backup image
-    backup_result(vesselness_img, affine_matrix, nii_header,
-                  os.path.join(logsDir, "2_hessian_based_vesselness.nii.gz"))
-
-    # --- Threshold image at (mean + 1.5 * std) ---
-
-    # Apply filter
-    thresholded_img = vesselness_thresholding(vesselness_img)
-    # Backup image
-    backup_result(thresholded_img, affine_matrix, nii_header,
-                  os.path.join(logsDir, "3_thresholded_vesselness.nii.gz"))
-
-    # --- FastMarching segmentation ---
-
-    # Apply filter
-    fastmarching_img, speed_img = fastmarching_segmentation(
-        smoothed_img, thresholded_img, affine_matrix, nii_header, logsDir
-    )
-    # Backup image
-    backup_result(fastmarching_img, affine_matrix, nii_header,
-                  os.path.join(logsDir, "4_fastmarching_segmentation.nii.gz"))
-
-    # # --- LevelSet segmentation ---
-
-    # # Apply filter
-    # levelset_img = levelset_segmentation(
-    #     fastmarching_img, speed_img
-    # )
-    # # Backup image
-    # backup_result(levelset_img, affine_matrix, nii_header,
-    #               os.path.join(logsDir, "5_levelset_segmentation.nii.gz"))
-
-    # Export to numpy
-    mask = itk.GetArrayFromImage(fastmarching_img)
+    # (converted to a C-ordered float32 array once, then shared as a view)
+    image_np = np.ascontiguousarray(image, dtype=np.float32)
+    image_in = itk.image_view_from_array(image_np)
+
+    # Back-ups are written in the background, by a thread pool that
+    # is local to this call (it waits for all writes when closed)
+    backups = []
+
+    with ThreadPoolExecutor(max_workers=2) as backup_pool:
+
+        # --- Anisotropic diffusion smoothing ---
+
+        # Apply filter
+        smoothed_img = anisotropic_diffusion_smoothing(image_in)
+        # Backup image
+        if backupInterResults:
+            backups.append(backup_result(
+                smoothed_img, affine_matrix, nii_header,
+                os.path.join(logsDir, "1_anisotropic_diff_smoothing.nii.gz"),
+                pool=backup_pool
+            ))
+
+        # --- Hessian-based vesselness map ---
+
+        # Apply filter
+        vesselness_img = hessian_vesselness(smoothed_img, avg_vox_dim)
+        # Backup image
+        if backupInterResults:
+            backups.append(backup_result(
+                vesselness_img, affine_matrix, nii_header,
+                os.path.join(logsDir, "2_hessian_based_vesselness.nii.gz"),
+                pool=backup_pool
+            ))
+
+        # --- Threshold image at (mean + 1.5 * std) ---
+
+        # Apply filter
+        thresholded_img = vesselness_thresholding(vesselness_img)
+        # Backup image
+        if backupInterResults:
+            backups.append(backup_result(
+                thresholded_img, affine_matrix, nii_header,
+                os.path.join(logsDir, "3_thresholded_vesselness.nii.gz"),
+                dtype=np.uint8, pool=backup_pool
+            ))
+
+        # --- FastMarching segmentation ---
+
+        # Apply filter
+        fastmarching_img, speed_img = fastmarching_segmentation(
+            smoothed_img, thresholded_img, affine_matrix, nii_header,
+            logsDir, backupInterResults=backupInterResults,
+            backupPool=backup_pool
+        )
+        # Backup image
+        if backupInterResults:
+            backups.append(backup_result(
+                fastmarching_img, affine_matrix, nii_header,
+                os.path.join(logsDir, "4_fastmarching_segmentation.nii.gz"),
+                dtype=np.uint8, pool=backup_pool
+            ))
+
+        # # --- LevelSet segmentation ---
+
+        # # Apply filter
+        # levelset_img = levelset_segmentation(
+        #     fastmarching_img, speed_img
+        # )
+        # # Backup image
+        # backup_result(levelset_img, affine_matrix, nii_header,
+        #               os.path.join(logsDir,
+        #                            "5_levelset_segmentation.nii.gz"))
+
+        # Make sure all back-ups are written
+        wait_for_backups(backups)
+
+    # Export to numpy (as view, without copying)
+    mask = itk.array_view_from_image(fastmarching_img)
     mask = np.moveaxis(mask, [0, 1, 2], [2, 1, 0])
 
     return mask
 
 
-def extract_vessels(seg_paths: dict):
+def extract_vessels(seg_paths: dict, n_threads: Optional[int] = None,
+                    backupInterResults: bool = True):
     """
     This function performs the actual segmentation part of the
     vessel segmentation. It uses some Frangi-filter based tricks
     to help in this process.
+    If given, the ITK filters are limited to 'n_threads' threads,
+    which avoids oversubscription when several subjects run in parallel.
+    As this changes ITK's global (process-wide) default, it should
+    only be given when running in a separate worker process.
+    If 'backupInterResults' is set, the intermediate results are
+    backed up to the subject's backup directory.
     """
 
+    # If applicable, set the number of ITK threads (for this process)
+    if n_threads:
+        itk.MultiThreaderBase.SetGlobalDefaultNumberOfThreads(n_threads)
+
     # Create back-up directory (for intermediate results)
     logsDir = seg_paths["backupDir"]
 
     # Extract relevant images
-    T1w_gado, ori_aff, ori_hdr = load_nifti(seg_paths["T1-gado"])
+    # (T1w-gado as float32, which is what the ITK filters use)
+    T1w_gado, ori_aff, ori_hdr = \
+        load_nifti(seg_paths["T1-gado"], np.float32)
     T1w_bet, bet_aff, _ = load_nifti(seg_paths["bet"])
-    csf_mask, csf_aff, _ = load_nifti(seg_paths["csf"])
 
-    # Transform CSF/BET masks to T1w-gado array space
-    bet_translation = (np.linalg.inv(bet_aff)).dot(ori_aff)
-    csf_translation = (np.linalg.inv(csf_aff)).dot(ori_aff)
+    # Transform BET mask to T1w-gado array space
+    T1w_bet = resample_to_grid(T1w_bet, bet_aff, ori_aff, np.shape(T1w_gado))
 
-    T1w_bet = affine_transform(T1w_bet, bet_translation,
-                               output_shape=np.shape(T1w_gado))
-    csf_mask = affine_transform(csf_mask, csf_translation,
-                                output_shape=np.shape(T1w_gado))
+    # Determine brain mask (used twice)
+    brain_mask = T1w_bet >= 1e-2
 
     # Remove non-brain from T1CE (gado) image
-    T1w_gado[T1w_bet < 1e-2] = 0
+    T1w_gado *= brain_mask
 
     # LevelSet vessel extraction
-    raw_mask = neumann_segmentation(T1w_gado, ori_aff, ori_hdr, logsDir)
+    raw_mask = neumann_segmentation(T1w_gado, ori_aff, ori_hdr, logsDir,
+                                    backupInterResults)
 
-    # Clean up mask
-    vessel_mask = raw_mask
-    vessel_mask[T1w_bet < 1e-2] = 0   # Remove non-brain
+    # Clean up mask (binarize and remove non-brain)
+    vessel_mask = raw_mask != 0
+    vessel_mask &= brain_mask
 
     # Prepare morphological operations
     avg_vox_dim = np.mean(np.absolute((ori_aff.diagonal())[:-1]))
 
     # Perform closing
-    element = morph.ball(int(2 / avg_vox_dim))
-    vessel_mask = morph.closing(vessel_mask, element)
+    element = ball_element(int(2 / avg_vox_dim))
+    vessel_mask = closing(vessel_mask, element)
 
     # Save vessel mask
-    nii_mask = nib.Nifti1Image(vessel_mask, ori_aff, ori_hdr)
+    nii_mask = nib.Nifti1Image(vessel_mask.astype(np.uint8), ori_aff, ori_hdr)
     nib.save(nii_mask, seg_paths["vessel_mask"])
 
 
@@ -513,7 +588,7 @@ def seg_vessels(paths: dict, settings: dict, verbose: bool = True):
     if "seg_paths" not in paths:
         paths["seg_paths"] = {}
 
-    if not os.path.isdir(paths["segDir"]): os.mkdir(paths["segDir"])
+    os.makedirs(paths["segDir"], exist_ok=True)
 
     # Generate processing paths (iteratively)
     seg_paths = []
@@ -521,10 +596,10 @@ def seg_vessels(paths: dict, settings: dict, verbose: bool = True):
     for subject in paths["nii_paths"]:
         # Create subject dir and raw subject dir
         subjectDir = os.path.join(paths["segDir"], subject)
-        if not os.path.isdir(subjectDir): os.mkdir(subjectDir)
+        os.makedirs(subjectDir, exist_ok=True)
 
         rawDir = os.path.join(subjectDir, "raw")
-        if not os.path.isdir(rawDir): os.mkdir(rawDir)
+        os.makedirs(rawDir, exist_ok=True)
 
         if subject not in paths["seg_paths"]:
             paths["seg_paths"][subject] = {
@@ -534,7 +609,7 @@ def seg_vessels(paths: dict, settings: dict, verbose: bool = True):
 
         # Create backup dict
         backupDir = os.path.join(rawDir, "vessel_debug")
-        if not os.path.isdir(backupDir): os.mkdir(backupDir)
+        os.makedirs(backupDir, exist_ok=True)
 
         # Define needed paths (originals + FSL-processed)
         T1_path = paths["nii_paths"][subject]["MRI_T1W"]
@@ -559,16 +634,10 @@ def seg_vessels(paths: dict, settings: dict, verbose: bool = True):
 
         seg_paths.append(subject_dict)
 
-    # Now, loop over seg_paths and perform ventricle segmentation
-    # Define iterator
-    if verbose:
-        iterator = tqdm(seg_paths, ascii=True,
-                        bar_format='{l_bar}{bar:30}{r_bar}{bar:-30b}')
-    else:
-        iterator = seg_paths
+    # Now, loop over seg_paths and select the subjects to process
+    jobs = []
 
-    # Main loop
-    for sub_paths in iterator:
+    for sub_paths in seg_paths:
         # Check whether output already there
         output_ok = os.path.exists(sub_paths["vessel_mask"])
 
@@ -579,14 +648,29 @@ def seg_vessels(paths: dict, settings: dict, verbose: bool = True):
                 continue
             elif settings["resetModules"][2] == 1:
                 # Generate vessel mask
-                extract_vessels(sub_paths)
+                jobs.append((sub_paths,))
             else:
                 raise ValueError("Parameter 'resetModules' should be a list "
                                  "containing only 0's and 1's. "
                                  "Please check the config file (config.json).")
         else:
             # Generate vessel mask
-            extract_vessels(sub_paths)
+            jobs.append((sub_paths,))
+
+    # Divide the available cores over the worker processes (ITK threads).
+    # This is a process-wide ITK setting, so it's only changed within
+    # worker processes. If the subjects run serially (in this process),
+    # ITK's own default is kept.
+    n_workers = count_workers(len(jobs), settings["maxWorkers"])
+    if n_workers > 1:
+        n_threads = max(1, (os.cpu_count() or 1) // n_workers)
+    else:
+        n_threads = None
+    backupInterResults = bool(settings["backupInterResults"])
+    jobs = [(*job, n_threads, backupInterResults) for job in jobs]
+
+    # Perform vessel segmentation (subjects in parallel)
+    run_parallel(extract_vessels, jobs, verbose, n_workers)
 
     # If some files were skipped, write message
     if verbose and skipped_img:
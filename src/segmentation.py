@@ -22,15 +22,83 @@ if src not in sys.path: sys.path.append(src)
 # File-specific imports
 import numpy as np                                      # noqa: E402
 import nibabel as nib                                   # noqa: E402
-from scipy.ndimage import affine_transform              # noqa: E402
 from seg.fsl import generate_fsl_paths, process_fsl     # noqa: E402
 from seg.ventricles import seg_ventricles               # noqa: E402
 from seg.sulci import seg_sulci                         # noqa: E402
 from seg.vessels import seg_vessels                     # noqa: E402
 from seg.entry_points import seg_entry_points           # noqa: E402
 from util.style import print_header, print_result       # noqa: E402
-from util.general import log_dict                       # noqa: E402
-from util.nifti import load_nifti                       # noqa: E402
+from util.general import log_dict, run_parallel         # noqa: E402
+from util.nifti import load_nifti, resample_to_grid     # noqa: E402
+
+
+def combine_masks(subject_paths: dict, mask_path: str):
+    """
+    This function combines the ventricle, sulcus and vessel masks
+    of a single subject into one final mask (stored at mask_path).
+    The ventricle/sulcus/entry masks are re-saved in the space
+    of the vessel mask.
+    """
+
+    # Now, load all partial masks
+    # (as float32, which suffices for the interpolation of binary masks)
+    ventricle_mask, vent_aff, _ = \
+        load_nifti(subject_paths["ventricle_mask"], np.float32)
+    sulcus_mask, sulc_aff, _ = \
+        load_nifti(subject_paths["sulcus_mask"], np.float32)
+    vessel_mask, vess_aff, hdr = \
+        load_nifti(subject_paths["vessel_mask"], np.float32)
+    entry_mask, entr_aff, _ = \
+        load_nifti(subject_paths["entry_points"], np.float32)
+
+    # Transform all masks to appropriate space
+    # (masks already on the vessel mask grid are not resampled)
+    sulcus_mask = resample_to_grid(
+        sulcus_mask, sulc_aff, vess_aff, np.shape(vessel_mask)
+    )
+    ventricle_mask = resample_to_grid(
+        ventricle_mask, vent_aff, vess_aff, np.shape(vessel_mask)
+    )
+    entry_mask = resample_to_grid(
+        entry_mask, entr_aff, vess_aff, np.shape(vessel_mask)
+    )
+
+    shapes_ok = (
+        (np.shape(ventricle_mask) == np.shape(sulcus_mask)) and
+        (np.shape(sulcus_mask) == np.shape(vessel_mask))
+    )
+    if not shapes_ok:
+        raise ValueError(
+            "The intermediate masks are not the same size!"
+            f"\nVentricle mask: {np.shape(ventricle_mask)}"
+            f"\nSulcus mask:    {np.shape(sulcus_mask)}"
+            f"\nVessel mask:    {np.shape(vessel_mask)}"
+        )
+
+    # Rebinarize all masks (as uint8, viewing the bool results)
+    ventricle_mask = (ventricle_mask >= 0.5).view(np.uint8)
+    sulcus_mask = (sulcus_mask >= 0.5).view(np.uint8)
+    entry_mask = (entry_mask >= 0.5).view(np.uint8)
+    vessel_mask = (vessel_mask > 1e-1).view(np.uint8)
+
+    # Combine masks (in a single union)
+    final_mask = ventricle_mask | sulcus_mask
+    final_mask |= vessel_mask
+
+    # Re-save ventricle/sulcus/entry masks in FSL orientation instead
+    # of FreeSurfer. This enables later co-registration to
+    # other images.
+
+    nib.save(nib.Nifti1Image(ventricle_mask, vess_aff, hdr),
+             subject_paths["ventricle_mask"])
+    nib.save(nib.Nifti1Image(sulcus_mask, vess_aff, hdr),
+             subject_paths["sulcus_mask"])
+    nib.save(nib.Nifti1Image(entry_mask, vess_aff, hdr),
+             subject_paths["entry_points"])
+
+    # Save final mask
+    nii_mask = nib.Nifti1Image(final_mask, vess_aff, hdr)
+    nib.save(nii_mask, mask_path)
 
 
 def finalize_segmentation(paths: dict, settings: dict, verbose: bool = True) \
@@ -41,14 +109,16 @@ def finalize_segmentation(paths: dict, settings: dict, verbose: bool = True) \
     - Firstly, we check for all the files and make sure everything is
     there.
     - Then, we combine the ventricle, sulcus and vessel masks
-    into one final mask.
+    into one final mask (subjects in parallel, see combine_masks()).
     """
 
     # Define all required items for paths dict
     required_paths = ["dir", "fs_labels", "ventricle_mask",
                       "sulcus_mask", "vessel_mask"]
 
-    # Loop through all subjects
+    # Loop through all subjects and select the ones to process
+    jobs = []
+
     for subject, subject_paths in paths["seg_paths"].items():
 
         # Now, check whether all relevant files are there
@@ -75,77 +145,10 @@ def finalize_segmentation(paths: dict, settings: dict, verbose: bool = True) \
 
         # If it doesn't already exist, combine masks
         if not os.path.exists(mask_path):
-            # Now, load all partial masks
-            ventricle_mask, vent_aff, _ = \
-                load_nifti(subject_paths["ventricle_mask"])
-            sulcus_mask, sulc_aff, _ = \
-                load_nifti(subject_paths["sulcus_mask"])
-            vessel_mask, vess_aff, hdr = \
-                load_nifti(subject_paths["vessel_mask"])
-            entry_mask, entr_aff, _ = \
-                load_nifti(subject_paths["entry_points"])
-
-            # Transform all masks to appropriate space
-            sulc_translation = (np.linalg.inv(sulc_aff)).dot(vess_aff)
-            vent_translation = (np.linalg.inv(vent_aff)).dot(vess_aff)
-            entr_translation = (np.linalg.inv(entr_aff)).dot(vess_aff)
-
-            sulcus_mask = affine_transform(
-                sulcus_mask, sulc_translation,
-                output_shape=np.shape(vessel_mask)
-            )
-            ventricle_mask = affine_transform(
-                ventricle_mask, vent_translation,
-                output_shape=np.shape(vessel_mask)
-            )
-            entry_mask = affine_transform(
-                entry_mask, entr_translation,
-                output_shape=np.shape(vessel_mask)
-            )
+            jobs.append((subject_paths, mask_path))
 
-            shapes_ok = (
-                (np.shape(ventricle_mask) == np.shape(sulcus_mask)) and
-                (np.shape(sulcus_mask) == np.shape(vessel_mask))
-            )
-            if shapes_ok:
-                final_mask = np.zeros(np.shape(vessel_mask))
-            else:
-                raise ValueError(
-                    "The intermediate masks are not the same size!"
-                    f"\nVentricle mask: {np.shape(ventricle_mask)}"
-                    f"\nSulcus mask:    {np.shape(sulcus_mask)}"
-                    f"\nVessel mask:    {np.shape(vessel_mask)}"
-                )
-
-            # Rebinarize ventricle/sulcus/entry masks
-            ventricle_mask[ventricle_mask >= 0.5] = 1.0
-            ventricle_mask[ventricle_mask < 0.5] = 0.0
-
-            sulcus_mask[sulcus_mask >= 0.5] = 1.0
-            sulcus_mask[sulcus_mask < 0.5] = 0.0
-
-            entry_mask[entry_mask >= 0.5] = 1.0
-            entry_mask[entry_mask < 0.5] = 0.0
-
-            # Combine masks
-            final_mask[ventricle_mask > 1e-1] = 1.0
-            final_mask[sulcus_mask > 1e-1] = 1.0
-            final_mask[vessel_mask > 1e-1] = 1.0
-
-            # Re-save ventricle/sulcus/entry masks in FSL orientation instead
-            # of FreeSurfer. This enables later co-registration to
-            # other images.
-
-            nib.save(nib.Nifti1Image(ventricle_mask, vess_aff, hdr),
-                     subject_paths["ventricle_mask"])
-            nib.save(nib.Nifti1Image(sulcus_mask, vess_aff, hdr),
-                     subject_paths["sulcus_mask"])
-            nib.save(nib.Nifti1Image(entry_mask, vess_aff, hdr),
-                     subject_paths["entry_points"])
-
-            # Save final mask
-            nii_mask = nib.Nifti1Image(final_mask, vess_aff, hdr)
-            nib.save(nii_mask, mask_path)
+    # Combine masks (subjects in parallel)
+    run_parallel(combine_masks, jobs, False, settings["maxWorkers"])
 
     return paths, settings
 
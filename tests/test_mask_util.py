@@ -0,0 +1,89 @@
+"""Tests for the mask utilities (seg.mask_util)"""
+
+# Path setup
+import os
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+src = os.path.join(root, "src")
+if root not in sys.path: sys.path.append(root)
+if src not in sys.path: sys.path.append(src)
+
+# File-specific imports
+import numpy as np                                      # noqa: E402
+import pytest                                           # noqa: E402
+import skimage.morphology as morph                      # noqa: E402
+from scipy import ndimage                               # noqa: E402
+from seg.mask_util import ellipsoid_element             # noqa: E402
+from seg.mask_util import ball_element, closing         # noqa: E402
+
+
+def test_ellipsoid_element_isotropic():
+    """
+    For isotropic voxels, the element should equal a ball.
+    """
+
+    element = ellipsoid_element(2., np.diag([0.5, 0.5, 0.5, 1.]))
+
+    np.testing.assert_array_equal(element, morph.ball(4).astype(bool))
+
+
+def test_ellipsoid_element_lia():
+    """
+    FreeSurfer's conformed (LIA) affine has a zero diagonal element.
+    The voxel dimensions should still be 1 mm along every axis.
+    """
+
+    lia_aff = np.array([[-1., 0., 0., 128.],
+                        [0., 0., 1., -128.],
+                        [0., -1., 0., 128.],
+                        [0., 0., 0., 1.]])
+    element = ellipsoid_element(2., lia_aff)
+
+    np.testing.assert_array_equal(element, morph.ball(2).astype(bool))
+
+
+def test_ellipsoid_element_anisotropic():
+    """
+    For anisotropic voxels, the element should become an ellipsoid.
+    """
+
+    element = ellipsoid_element(2., np.diag([1., 1., 2., 1.]))
+
+    assert np.shape(element) == (5, 5, 3)
+    assert element[2, 2, :].all() and element[:, 2, 1].all()
+
+
+def test_ellipsoid_element_invalid_affine():
+    """
+    A singular affine (zero voxel size) should raise an error.
+    """
+
+    with pytest.raises(ValueError):
+        ellipsoid_element(2., np.diag([1., 0., 1., 1.]))
+
+
+def test_closing_border():
+    """
+    The closing should mirror the mask at the volume border,
+    like skimage's (greyscale) closing does.
+    """
+
+    rng = np.random.default_rng(1)
+
+    for radius in (1, 2, 3):
+        # Random blobs, touching the volume border
+        noise = ndimage.gaussian_filter(rng.random((30, 34, 28)), 2)
+        mask = noise > np.percentile(noise, 70)
+
+        assert mask[0].any()
+        np.testing.assert_array_equal(
+            closing(mask, ball_element(radius)),
+            morph.closing(mask.astype(np.uint8), morph.ball(radius)) != 0
+        )
+
+    # Small blob at the volume border
+    mask = np.zeros((20, 20, 20), dtype=bool)
+    mask[0:3, 5:8, 5:9] = True
+
+    np.testing.assert_array_equal(closing(mask, ball_element(2)), mask)
@@ -0,0 +1,128 @@
+"""Tests for the ventricle region growing (seg.ventricles)"""
+
+# Path setup
+import os
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+src = os.path.join(root, "src")
+if root not in sys.path: sys.path.append(root)
+if src not in sys.path: sys.path.append(src)
+
+# File-specific imports
+import numpy as np                                      # noqa: E402
+import skimage.morphology as morph                      # noqa: E402
+from scipy import ndimage                               # noqa: E402
+from seg.ventricles import find_seed_mask, region_growing  # noqa: E402
+
+
+def reference_region_growing(seed_mask: np.ndarray, full_mask: np.ndarray,
+                             avg_vox_dim: float,
+                             element_size: int = 2) -> np.ndarray:
+    """
+    This function is the original (scikit-image based) region growing
+    implementation. It is used as a reference for region_growing().
+    """
+
+    # Build morphological structuring element
+    element = morph.ball(int(element_size / avg_vox_dim))
+    big_element = morph.ball(int(element_size * 1.5 / avg_vox_dim))
+    small_element = morph.ball(1)
+
+    # Perform openings of full mask
+    crude_mask = morph.opening(full_mask, big_element)
+    full_mask = morph.opening(full_mask, element)
+
+    # Perform crude region growing loop
+    stop_loop = False
+    previous_output = seed_mask
+    loop_n = 0
+    while not stop_loop:
+        loop_n += 1
+        new_output = morph.dilation(previous_output, element) * crude_mask
+        stop_loop = (previous_output == new_output).all() or (loop_n > 50)
+        previous_output = new_output
+
+    # Perform fine region growing loop
+    stop_loop = False
+    while not stop_loop:
+        new_output = morph.dilation(previous_output, small_element) * full_mask
+        stop_loop = (previous_output == new_output).all()
+        previous_output = new_output
+
+    return previous_output.astype(bool)
+
+
+def test_region_growing_border():
+    """
+    The openings should mirror the mask at the volume border,
+    like the original greyscale openings did.
+    """
+
+    rng = np.random.default_rng(1)
+
+    for avg_vox_dim in (1.0, 0.5, 0.7):
+        # Random blobs, touching the volume border
+        noise = ndimage.gaussian_filter(rng.random((40, 44, 38)), 3)
+        full_mask = (noise > np.percentile(noise, 45)).astype(np.uint8)
+
+        seed_mask = np.zeros(np.shape(full_mask), dtype=np.uint8)
+        full_idx = np.argwhere(full_mask)
+        for i in rng.choice(len(full_idx), 3):
+            seed_mask[tuple(full_idx[i])] = 1
+
+        assert full_mask[0].any()
+        np.testing.assert_array_equal(
+            region_growing(seed_mask, full_mask, avg_vox_dim),
+            reference_region_growing(seed_mask, full_mask, avg_vox_dim)
+        )
+
+
+def test_region_growing_iterations():
+    """
+    The crude region growing should perform (at most) 51 dilations.
+    A chain of cubes separated by 1-voxel gaps may only be crossed
+    by the crude step, so its length shows the number of dilations.
+    """
+
+    # Build chain of cubes (7x7x7 voxels)
+    full_mask = np.zeros((9, 9, 140), dtype=np.uint8)
+    for z0 in range(0, 140 - 7, 8):
+        full_mask[1:8, 1:8, z0:z0 + 7] = 1
+
+    seed_mask = np.zeros(np.shape(full_mask), dtype=np.uint8)
+    seed_mask[4, 4, 3] = 1
+
+    output = region_growing(seed_mask, full_mask, 1.0)
+
+    np.testing.assert_array_equal(
+        output, reference_region_growing(seed_mask, full_mask, 1.0)
+    )
+    assert np.sum(output) == 2546
+
+
+def test_find_seed_mask_border():
+    """
+    The erosion should treat the volume border as foreground,
+    like the original greyscale erosion (morph.erosion) did.
+    """
+
+    rng = np.random.default_rng(2)
+
+    # Random blobs, touching the volume border (center near the border)
+    noise = ndimage.gaussian_filter(rng.random((40, 40, 40)), 3)
+    csf_mask = (noise > np.percentile(noise, 30)).astype(np.uint8)
+    center_coords = (5, 20, 20)
+
+    # Original implementation
+    eroded_mask = morph.erosion(csf_mask, morph.ball(4))
+    xx, yy, zz = np.indices(np.shape(csf_mask))
+    dist2center = np.sqrt((xx - center_coords[0]) ** 2 +
+                          (yy - center_coords[1]) ** 2 +
+                          (zz - center_coords[2]) ** 2)
+    reference_mask = (eroded_mask * (dist2center < 20)) != 0
+
+    assert reference_mask[0].any()
+    np.testing.assert_array_equal(
+        find_seed_mask(csf_mask, 1.0, center_coords), reference_mask
+    )
@@ -1,7 +1,12 @@
 """Utility module for general functions"""
 
+import os
 import sys
 import json
+import shutil
+from typing import Callable, Optional
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
 
 
 def log_dict(dict: dict, file: str, mode: str = "w"):
@@ -74,3 +79,83 @@ def extract_json(json_path: str, verbose: bool = False):
         if verbose: print(data)
 
         return data
+
+
+def check_up_to_date(src_path: str, dst_path: str) -> bool:
+    """
+    This function checks whether a derived file (dst_path) exists
+    and is at least as recent as the file it was derived from (src_path).
+    It may be used to skip redundant (slow) file conversions.
+    """
+
+    return os.path.exists(dst_path) and \
+        os.path.getmtime(dst_path) >= os.path.getmtime(src_path)
+
+
+def link_or_copy(src_path: str, dst_path: str):
+    """
+    This function makes a file available at a second location.
+    If possible, it creates a hard link (no data is copied).
+    If not (e.g. across file systems), the file is copied instead.
+    """
+
+    # Remove outdated version of destination file
+    if os.path.exists(dst_path): os.remove(dst_path)
+
+    # Try to create a hard link, otherwise copy the file
+    try:
+        os.link(src_path, dst_path)
+    except OSError:
+        shutil.copyfile(src_path, dst_path)
+
+
+def count_workers(n_jobs: int, max_workers: Optional[int] = None) -> int:
+    """
+    This function determines the number of worker processes
+    used by run_parallel() for a given number of jobs.
+    If 'max_workers' is not given, half of the available cores is used.
+    """
+
+    if not max_workers:
+        max_workers = max(1, (os.cpu_count() or 1) // 2)
+
+    return max(1, min(max_workers, n_jobs))
+
+
+def run_parallel(function: Callable, jobs: list, verbose: bool = True,
+                 max_workers: Optional[int] = None) -> list:
+    """
+    This function runs a function for a list of independent jobs
+    (e.g. subjects) in a pool of worker processes.
+    Every job is a tuple of arguments passed on to the function.
+    The results are returned in the same order as the jobs.
+    If 'max_workers' is not given, half of the available cores is used.
+    """
+
+    # Initialize results list
+    results = [None] * len(jobs)
+    if not jobs: return results
+
+    # Determine the number of worker processes
+    max_workers = count_workers(len(jobs), max_workers)
+
+    # Define progress bar settings
+    bar_kwargs = {"total": len(jobs), "ascii": True,
+                  "bar_format": '{l_bar}{bar:30}{r_bar}{bar:-30b}',
+                  "disable": not verbose}
+
+    # If there is only one worker, simply run the jobs serially
+    if max_workers == 1:
+        for job_i, job in tqdm(enumerate(jobs), **bar_kwargs):
+            results[job_i] = function(*job)
+        return results
+
+    # Otherwise, distribute the jobs over the worker processes
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(function, *job): job_i
+                   for job_i, job in enumerate(jobs)}
+
+        for future in tqdm(as_completed(futures), **bar_kwargs):
+            results[futures[future]] = future.result()
+
+    return results
@@ -3,24 +3,72 @@
 import numpy as np
 import nibabel as nib
 import subprocess
+from scipy.ndimage import affine_transform
 
 
-def load_nifti(path: str) \
+def load_nifti(path: str, dtype: type = np.float64) \
         -> tuple[np.ndarray, np.ndarray, nib.nifti1.Nifti1Header]:
     """
     This function loads a nifti image using
     the nibabel library.
+    The data is returned as floats of type 'dtype' (float32 or float64).
     """
     # Extract image
     img = nib.load(path)
     img_aff = img.affine
     img_hdr = img.header
     # Extract the actual data in a numpy array
-    data = img.get_fdata()
+    data = img.get_fdata(dtype=dtype)
 
     return data, img_aff, img_hdr
 
 
+def resample_to_grid(data: np.ndarray, data_aff: np.ndarray,
+                     grid_aff: np.ndarray, grid_shape: tuple,
+                     order: int = 3) -> np.ndarray:
+    """
+    This function resamples an image (or mask) onto the voxel grid
+    of another image. Both grids are defined by their affine
+    matrices, while the output shape is given by 'grid_shape'.
+    The actual interpolation is performed by scipy's affine_transform.
+    If both grids (nearly) coincide, the data itself is returned.
+    If they only differ by a whole number of voxels, the data is
+    simply shifted (which is what the interpolation would yield).
+    """
+
+    # Determine voxel-to-voxel transformation (grid --> data)
+    aff_translation = np.linalg.solve(data_aff, grid_aff)
+    rotation, shift = aff_translation[:3, :3], aff_translation[:3, 3]
+
+    # If the grids coincide (up to rounding errors), skip resampling
+    if np.shape(data) == tuple(grid_shape) and \
+            np.allclose(aff_translation, np.eye(4), rtol=0., atol=1e-6):
+        return data
+
+    # If the grids are shifted by whole voxels, copy the overlapping block
+    if np.allclose(rotation, np.eye(3), rtol=0., atol=1e-6) and \
+            np.allclose(shift, np.round(shift), rtol=0., atol=1e-6):
+        shift = np.round(shift).astype(int)
+        resampled_data = np.zeros(grid_shape, dtype=data.dtype)
+
+        src_start = np.clip(shift, 0, np.shape(data))
+        src_stop = np.clip(shift + np.array(grid_shape), 0, np.shape(data))
+        size = np.maximum(src_stop - src_start, 0)
+        dst_start = src_start - shift
+
+        resampled_data[tuple(slice(i, i + n)
+                             for i, n in zip(dst_start, size))] = \
+            data[tuple(slice(i, i + n) for i, n in zip(src_start, size))]
+
+        return resampled_data
+
+    # Perform transformation
+    resampled_data = affine_transform(data, aff_translation,
+                                      output_shape=grid_shape, order=order)
+
+    return resampled_data
+
+
 def mgz2nii(mgz_path: str, nii_path: str):
     """
     This function performs an mgz to nii conversion.